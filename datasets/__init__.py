@@ -1,6 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 
-from .kinetics import Kinetics  # noqa
+from .kinetics import Kinetics, kinetics_collate  # noqa
 from .ucf101 import UCF101
 from .hmdb51 import HMDB51
 # from .ssv2 import Ssv2  # noqa
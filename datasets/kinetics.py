@@ -6,6 +6,7 @@ import warnings
 from PIL import Image
 import torch
 import torch.utils.data
+from torch.utils.data.dataloader import default_collate
 import torchvision
 import kornia
 
@@ -17,6 +18,22 @@ from datasets.transform import VideoDataAugmentationDINO
 from einops import rearrange
 from datasets.masking_generator import TubeMaskingGenerator
 
+def kinetics_collate(batch):
+    """
+    Collate the Kinetics train samples, packing the masks of all the views into
+    one flat uint8 tensor so that they reach the gpu in a single copy. The views
+    may have different numbers of frames, so the masks are concatenated view by
+    view, each one flattened from `batch` x `num frames` x `num patches`.
+    """
+    frames, masks, labels, indices, meta = zip(*batch)
+    if len(masks[0]) > 0:
+        masks = torch.cat([torch.stack(view).flatten() for view in zip(*masks)])
+    else:
+        masks = torch.zeros(0, dtype=torch.uint8)
+    frames, labels, indices, meta = default_collate(list(zip(frames, labels, indices, meta)))
+    return frames, masks, labels, indices, meta
+
+
 class Kinetics(torch.utils.data.Dataset):
     """
     Kinetics video loader. Construct the Kinetics video loader, then sample
@@ -28,7 +45,7 @@ class Kinetics(torch.utils.data.Dataset):
     bottom crop if the height is larger than the width.
     """
 
-    def __init__(self, cfg, mode, num_retries=10, mask_ratio=0.9, get_flow=False):
+    def __init__(self, cfg, mode, num_retries=10, mask_ratio=0.9, get_flow=False, to_uint8=False):
         """
         Construct the Kinetics video loader with a given csv file. The format of
         the csv file is:
@@ -46,6 +63,8 @@ class Kinetics(torch.utils.data.Dataset):
                 For the test mode, the data loader will take data from test set,
                 and sample multiple clips per video.
             num_retries (int): number of retries.
+            to_uint8 (bool): if True, the augmented train views are returned as
+                uint8 tensors and must be normalized by the caller.
         """
         # Only support train, val, and test mode.
         assert mode in [
@@ -60,6 +79,7 @@ class Kinetics(torch.utils.data.Dataset):
         self.get_flow = get_flow
         self.get_flow = get_flow
         self.mask_ratio = mask_ratio
+        self.to_uint8 = to_uint8
         self._video_meta = {}
         self._num_retries = num_retries
         # For training or validation mode, one single clip is sampled from every
@@ -295,7 +315,8 @@ class Kinetics(torch.utils.data.Dataset):
                 frames = [rearrange(x, "t h w c -> t c h w") for x in frames]
 
                 # Perform data augmentation.
-                augmentation = VideoDataAugmentationDINO()
+                augmentation = VideoDataAugmentationDINO(to_uint8=self.to_uint8,
+                                                         color_jitter=not self.cfg.DATA.GPU_COLOR_AUG)
                 frames = augmentation(frames, from_list=True, no_aug=self.cfg.DATA.NO_SPATIAL,
                                       two_token=self.cfg.MODEL.TWO_TOKEN)
 
@@ -317,7 +338,7 @@ class Kinetics(torch.utils.data.Dataset):
                     _,T_global,H_global,W_global = mask_image.shape
                     mask_function = TubeMaskingGenerator((T_global, H_global // 16, W_global // 16), self.mask_ratio)
                     mask = mask_function()
-                    masks.append(mask)
+                    masks.append(torch.from_numpy(mask).to(torch.uint8))
 
             meta_data = {}
             if self.get_flow:
@@ -330,7 +351,7 @@ class Kinetics(torch.utils.data.Dataset):
                         flow_tensor = resize(flow_tensor, size=self.cfg.DATA.CROP_SIZE, mode="bicubic")
                         flow_tensor = [x for x in flow_tensor]
                     else:
-                        flow_tensor = augmentation(flow_tensor)
+                        flow_tensor = VideoDataAugmentationDINO()(flow_tensor)
                         flow_tensor = [rearrange(x, "t c h w -> c t h w") for x in flow_tensor]
                     meta_data["flow"] = flow_tensor
                 except Exception as e:
@@ -461,6 +461,49 @@ def saturation_jitter(var, images):
     return images
 
 
+def batch_color_jitter(images, img_brightness=0, img_contrast=0, img_saturation=0, jitter_prob=0.8,
+                       grayscale_prob=0.2):
+    """
+    Batched version of the `color_jitter` / `grayscale` pair applied by
+    `VideoDataAugmentationDINO`, to be run on the gpu. Every clip draws its own
+    jitter factors and its own coin flips, the jitter order is drawn once per
+    call. The channels of images should be in order BGR.
+    Args:
+        images (tensor): images to perform color jitter, with values in [0, 1].
+            Dimension is `batch` x `channel` x `num frames` x `height` x `width`.
+        img_brightness (float): jitter ratio for brightness.
+        img_contrast (float): jitter ratio for contrast.
+        img_saturation (float): jitter ratio for saturation.
+        jitter_prob (float): probability to jitter a clip.
+        grayscale_prob (float): probability to turn a clip to grayscale.
+    Returns:
+        images (tensor): the jittered images clamped to [0, 1], the dimension is
+            `batch` x `channel` x `num frames` x `height` x `width`.
+    """
+
+    def gray(x):
+        # R -> 0.299, G -> 0.587, B -> 0.114.
+        return (0.299 * x[:, 2] + 0.587 * x[:, 1] + 0.114 * x[:, 0]).unsqueeze(1)
+
+    def sample_alpha(var):
+        return 1.0 + torch.empty(shape, device=images.device).uniform_(-var, var)
+
+    shape = (images.size(0), 1, 1, 1, 1)
+    jittered = images
+    for idx in np.random.permutation(3):
+        if idx == 0 and img_brightness != 0:
+            jittered = jittered * sample_alpha(img_brightness)
+        elif idx == 1 and img_contrast != 0:
+            mean = gray(jittered).mean(dim=(1, 3, 4), keepdim=True)  # per frame, as in `contrast_jitter`
+            jittered = blend(jittered, mean, sample_alpha(img_contrast))
+        elif idx == 2 and img_saturation != 0:
+            jittered = blend(jittered, gray(jittered), sample_alpha(img_saturation))
+    images = torch.where(torch.rand(shape, device=images.device) < jitter_prob, jittered, images)
+    images = torch.where(torch.rand(shape, device=images.device) < grayscale_prob, gray(images), images)
+    # the cpu pipeline clamps when it quantizes to uint8
+    return images.clamp_(0, 1)
+
+
 def lighting_jitter(images, alphastd, eigval, eigvec):
     """
     Perform AlexNet-style PCA jitter on the given images.
@@ -605,14 +648,21 @@ class GaussianBlur(nn.Module):
         self.kernel_size: Tuple[int, int] = kernel_size
         self.sigma: Tuple[float, float] = sigma
         self._padding: Tuple[int, int] = self.compute_zero_padding(kernel_size)
-        self.kernel: torch.Tensor = self.create_gaussian_kernel(
+        self.kernel_x, self.kernel_y = self.create_gaussian_kernels(
             kernel_size, sigma)
 
     @staticmethod
-    def create_gaussian_kernel(kernel_size, sigma) -> torch.Tensor:
-        """Returns a 2D Gaussian kernel array."""
-        kernel: torch.Tensor = get_gaussian_kernel2d(kernel_size, sigma)
-        return kernel
+    def create_gaussian_kernels(kernel_size, sigma) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the 1D Gaussian kernels along the height and the width."""
+        if not isinstance(kernel_size, tuple) or len(kernel_size) != 2:
+            raise TypeError("ksize must be a tuple of length two. Got {}"
+                            .format(kernel_size))
+        if not isinstance(sigma, tuple) or len(sigma) != 2:
+            raise TypeError("sigma must be a tuple of length two. Got {}"
+                            .format(sigma))
+        kernel_x: torch.Tensor = get_gaussian_kernel(kernel_size[0], sigma[0])
+        kernel_y: torch.Tensor = get_gaussian_kernel(kernel_size[1], sigma[1])
+        return kernel_x, kernel_y
 
     @staticmethod
     def compute_zero_padding(kernel_size: Tuple[int, int]) -> Tuple[int, int]:
@@ -627,13 +677,14 @@ class GaussianBlur(nn.Module):
         if not len(x.shape) == 4:
             raise ValueError("Invalid input shape, we expect BxCxHxW. Got: {}"
                              .format(x.shape))
-        # prepare kernel
+        # prepare kernels, the 2D gaussian is the outer product of two 1D ones
         b, c, h, w = x.shape
-        tmp_kernel: torch.Tensor = self.kernel.to(x.device).to(x.dtype)
-        kernel: torch.Tensor = tmp_kernel.repeat(c, 1, 1, 1)
+        kernel_x: torch.Tensor = self.kernel_x.to(x.device, x.dtype).view(1, 1, -1, 1).repeat(c, 1, 1, 1)
+        kernel_y: torch.Tensor = self.kernel_y.to(x.device, x.dtype).view(1, 1, 1, -1).repeat(c, 1, 1, 1)
 
-        # convolve tensor with gaussian kernel
-        return conv2d(x, kernel, padding=self._padding, stride=1, groups=c)
+        # convolve tensor with the two separable passes, 2K instead of K^2 products per pixel
+        x = conv2d(x, kernel_x, padding=(self._padding[0], 0), stride=1, groups=c)
+        return conv2d(x, kernel_y, padding=(0, self._padding[1]), stride=1, groups=c)
 
 
 def undo_normalize(tensor, mean, std):
@@ -659,24 +710,33 @@ def undo_normalize(tensor, mean, std):
 
 
 class VideoDataAugmentationDINO(object):
-    def __init__(self, global_crops_scale=(0.4, 1.0), local_crops_scale=(0.05, 0.4), local_crops_number=8):
+    def __init__(self, global_crops_scale=(0.4, 1.0), local_crops_scale=(0.05, 0.4), local_crops_number=8,
+                 to_uint8=False, color_jitter=True):
         self.global_crops_scale = global_crops_scale
         self.local_crops_scale = local_crops_scale
         self.local_crops_number = local_crops_number
+        # return uint8 crops and leave the mean/std normalization to the training loop
+        self.to_uint8 = to_uint8
+        # if False, color jitter and grayscale are left to `batch_color_jitter` in the training loop
+        self.color_jitter = color_jitter
 
         self.gaussian_kernel = GaussianBlur((3, 3), (1.5, 1.5))
 
-    @staticmethod
-    def flip_and_color_jitter(frames):
+    def flip_and_color_jitter(self, frames):
         frames, _ = horizontal_flip(prob=0.5, images=frames)
+        if not self.color_jitter:
+            return frames
         if np.random.uniform() < 0.8:
             frames = color_jitter(frames, img_brightness=0.4, img_contrast=0.4, img_saturation=0.2)
         if np.random.uniform() < 0.2:
             frames = grayscale(frames)
         return frames
 
-    @staticmethod
-    def normalize(frames):
+    def normalize(self, frames):
+        if self.to_uint8:
+            # quantized to steps of 1/255 and clamped to [0, 1], unlike the float path which keeps
+            # the brightness jitter and bicubic overshoot above 1.0
+            return frames.mul(255.0).round_().clamp_(0, 255).to(torch.uint8)
         frames = color_normalization(frames, mean=[0.485, 0.456, 0.406], stddev=[0.229, 0.224, 0.225])
         return frames
 
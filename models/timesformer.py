@@ -65,7 +65,7 @@ class Attention(nn.Module):
             self.proj_drop = nn.Dropout(proj_drop)
         self.attn_drop = nn.Dropout(attn_drop)
 
-    def forward(self, x, return_attn=False):
+    def forward(self, x, return_attn=False, cls_only=False):
         B, N, C = x.shape
         if self.with_qkv:
             qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
@@ -83,6 +83,9 @@ class Attention(nn.Module):
             x = self.proj(x)
             x = self.proj_drop(x)
         if return_attn:
+            if cls_only:
+                # attention of the [CLS] query to the patch tokens, averaged over heads
+                return x, attn[:, :, 0, 1:].mean(dim=1)
             return x, attn
         return x
 
@@ -113,7 +116,7 @@ class Block(nn.Module):
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x, B, T, W, return_attn=False):
+    def forward(self, x, B, T, W, return_attn=False, cls_only=False):
         num_spatial_tokens = (x.size(1) - self.class_tokens) // T
         H = num_spatial_tokens // W
 
@@ -153,7 +156,7 @@ class Block(nn.Module):
             else:
                 xs = torch.cat((cls_token, xs, aux_cls_token), 1)
             if return_attn:
-                _, attn = self.attn(self.norm1(xs), return_attn=return_attn)
+                _, attn = self.attn(self.norm1(xs), return_attn=return_attn, cls_only=cls_only)
                 return attn
             else:
                 res_spatial = self.drop_path(self.attn(self.norm1(xs)))
@@ -295,7 +298,7 @@ class VisionTransformer(nn.Module):
         self.num_classes = num_classes
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
-    def forward_features(self, x, mask, get_attn=False, get_all=False):
+    def forward_features(self, x, mask, get_attn=False, get_all=False, return_cls=False, cls_only=False):
         B = x.shape[0]
         th = x.shape[-1] // 16
         x_origin = x
@@ -358,7 +361,7 @@ class VisionTransformer(nn.Module):
                 else:
                     # return attention of the last block
                     x = blk(x, B, T, W)
-                    attn_last = blk(t, B, T, W, return_attn=True)
+                    attn_last = blk(t, B, T, W, return_attn=True, cls_only=cls_only)
         else:
             # Attention blocks
             for blk in self.blocks:
@@ -368,6 +371,7 @@ class VisionTransformer(nn.Module):
         if get_all:
             return x
         if mask is not None:
+            cls = x[:, 0]
             x = x[:, 1:]
             B, L, C = x.shape
             L = L // T
@@ -380,6 +384,8 @@ class VisionTransformer(nn.Module):
             x_origin = rearrange(x_origin, 'b t c h w -> (b t) c h w')
             loss_recon = F.l1_loss(x_origin, x_rec, reduction='none')
             loss = (loss_recon * mask).sum() / (mask.sum() + 1e-5) / 3
+            if return_cls:
+                return loss, cls
             return loss, x_rec
         else:
             if get_attn:
@@ -387,8 +393,8 @@ class VisionTransformer(nn.Module):
             else:
                 return x[:, 0]
 
-    def forward(self, x, mask=None, get_attn=False ,use_head=False):
-        x = self.forward_features(x, mask, get_attn)
+    def forward(self, x, mask=None, get_attn=False ,use_head=False, return_cls=False, cls_only=False):
+        x = self.forward_features(x, mask, get_attn, return_cls=return_cls, cls_only=cls_only)
         if use_head:
             x = self.head(x)
         return x
@@ -1,18 +1,22 @@
-#!/bin/bash
-
-python -m torch.distributed.launch \
-  --nproc_per_node=4 \
-  --master_port="$RANDOM" \
-  train_ssl.py \
-  --arch "timesformer" \
-  --batch_size_per_gpu 3 \
-  --data_path "./data/pretrain" \
-  --output_dir "./output" \
-  --opts \
-  MODEL.TWO_STREAM False \
-  MODEL.TWO_TOKEN False \
-  DATA.NO_FLOW_AUG False \
-  DATA.USE_FLOW False \
-  DATA.RAND_CONV False \
-  DATA.NO_SPATIAL False
-
+#!/bin/bash
+
+# On multi-node jobs point NCCL at the right interfaces, e.g.
+# export NCCL_IB_HCA=mlx5
+# export NCCL_SOCKET_IFNAME=eth0
+
+python -m torch.distributed.launch \
+  --nproc_per_node=4 \
+  --master_port="$RANDOM" \
+  train_ssl.py \
+  --arch "timesformer" \
+  --batch_size_per_gpu 3 \
+  --data_path "./data/pretrain" \
+  --output_dir "./output" \
+  --opts \
+  MODEL.TWO_STREAM False \
+  MODEL.TWO_TOKEN False \
+  DATA.NO_FLOW_AUG False \
+  DATA.USE_FLOW False \
+  DATA.RAND_CONV False \
+  DATA.NO_SPATIAL False
+
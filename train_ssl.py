@@ -19,6 +19,8 @@ import time
 import math
 import json
 from pathlib import Path
+import matplotlib
+matplotlib.use('Agg')  # plots are only written to disk
 import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
@@ -33,10 +35,10 @@ from datasets.rand_conv import RandConv
 from utils import utils
 import vision_transformer as vits
 from vision_transformer import DINOHead, MultiDINOHead
-from datasets import Kinetics
+from datasets import Kinetics, kinetics_collate
+from datasets.transform import batch_color_jitter
 from models import get_vit_base_patch16_224, get_aux_token_vit
 from utils.parser import load_config
-from einops import rearrange
 
 torchvision_archs = sorted(name for name in torchvision_models.__dict__
                            if name.islower() and not name.startswith("__")
@@ -83,6 +85,12 @@ def get_args_parser():
         to use half precision for training. Improves training time and memory requirements,
         but can provoke instability and slight decay of performance. We recommend disabling
         mixed precision if the loss is unstable, if reducing the patch size or if training with bigger ViTs.""")
+    parser.add_argument('--amp_dtype', default=None, type=str, choices=['fp16', 'bf16'], help="""Half precision
+        type used with --use_fp16. bf16 has the range of fp32 and does not need a gradient scaler. Defaults to bf16
+        when the GPU supports it (Ampere and newer), fp16 otherwise.""")
+    parser.add_argument('--compile_loss', type=utils.bool_flag, default=False, help="""Whether or not
+        to compile the multi-crop DINO cross-entropy with torch.compile and CUDA graphs. Needs a torch version
+        providing torch.compile, ignored otherwise.""")
     parser.add_argument('--weight_decay', type=float, default=0.04, help="""Initial value of the
         weight decay. With ViT, a smaller value at the beginning of training works well.""")
     parser.add_argument('--weight_decay_end', type=float, default=0.4, help="""Final value of the
@@ -150,9 +158,15 @@ def get_args_parser():
 def train_svt(args):
     utils.init_distributed_mode(args)
     utils.fix_random_seeds(args.seed)
+    if args.amp_dtype is None:
+        args.amp_dtype = "bf16" if torch.cuda.is_bf16_supported() else "fp16"
     print("git:\n  {}\n".format(utils.get_sha()))
     print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
     cudnn.benchmark = True
+    # TF32 for the fp32 GEMMs and convolutions on Ampere and newer, i.e. the whole forward with
+    # --use_fp16 false; the DINO pair cross-entropy turns it off for its einsum
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 
     masking_ratio = args.masking_ratio
     threshold = args.threshold
@@ -163,9 +177,15 @@ def train_svt(args):
     if utils.is_main_process():
         json.dump(vars(args), open(Path(args.output_dir) / "config.txt", "w"), indent=4)
     config.DATA.PATH_TO_DATA_DIR = args.data_path
+    if config.DATA.GPU_COLOR_AUG:
+        # the gpu jitter treats every view the same, which only matches the default multi-crop augmentation
+        assert not (config.MODEL.TWO_TOKEN or config.DATA.NO_SPATIAL or config.DATA.NO_RGB_AUG), \
+            "DATA.GPU_COLOR_AUG is not supported with MODEL.TWO_TOKEN, DATA.NO_SPATIAL or DATA.NO_RGB_AUG"
 
+    # the gpu color jitter works on the uint8 views
+    to_uint8 = config.DATA.UINT8_VIEWS or config.DATA.GPU_COLOR_AUG
     dataset = Kinetics(cfg=config, mode="train", num_retries=10, mask_ratio=masking_ratio,
-                       get_flow=config.DATA.USE_FLOW)
+                       get_flow=config.DATA.USE_FLOW, to_uint8=to_uint8)
     sampler = torch.utils.data.DistributedSampler(dataset, shuffle=True)
     data_loader = torch.utils.data.DataLoader(
         dataset,
@@ -174,6 +194,8 @@ def train_svt(args):
         num_workers=args.num_workers,
         pin_memory=True,
         drop_last=True,
+        collate_fn=kinetics_collate,
+        persistent_workers=args.num_workers > 0,  # keep the worker processes alive across epochs
     )
     print(f"Train data loaded: there are {len(dataset)} images.")
 
@@ -181,6 +203,7 @@ def train_svt(args):
         rand_conv = RandConv(temporal_input=True).cuda()
     else:
         rand_conv = None
+    ema_stream = torch.cuda.Stream()  # side stream the teacher EMA update is issued on
     # ============ building student and teacher networks ... ============
     # we changed the name DeiT-S for ViT-S to avoid confusions
     args.arch = args.arch.replace("deit", "vit")
@@ -281,13 +304,18 @@ def train_svt(args):
         student = nn.SyncBatchNorm.convert_sync_batchnorm(student)
         teacher = nn.SyncBatchNorm.convert_sync_batchnorm(teacher)
         # we need DDP wrapper to have synchro batch norms working...
-        teacher = nn.parallel.DistributedDataParallel(teacher, device_ids=[args.gpu], find_unused_parameters=False)
+        # SyncBatchNorm keeps the running stats identical across ranks, no need to broadcast them every forward
+        teacher = nn.parallel.DistributedDataParallel(teacher, device_ids=[args.gpu], find_unused_parameters=False,
+                                                      broadcast_buffers=False)
         teacher_without_ddp = teacher.module
     else:
         # teacher_without_ddp and teacher are the same thing
         teacher_without_ddp = teacher
 
-    student = nn.parallel.DistributedDataParallel(student, device_ids=[args.gpu], find_unused_parameters=False)
+    # the student traverses the same modules every iteration, so DDP can treat its graph as static
+    student = nn.parallel.DistributedDataParallel(student, device_ids=[args.gpu], find_unused_parameters=False,
+                                                  gradient_as_bucket_view=True, bucket_cap_mb=100)
+    student._set_static_graph()
     msg = teacher_without_ddp.load_state_dict(student.module.state_dict(), strict=False)
     print(f"initialized teacher with student msg: {msg}")
     for p in teacher.parameters():
@@ -298,13 +326,17 @@ def train_svt(args):
         if utils.has_batchnorms(motion_student):
             motion_student = nn.SyncBatchNorm.convert_sync_batchnorm(motion_student)
             motion_teacher = nn.SyncBatchNorm.convert_sync_batchnorm(motion_teacher)
-            motion_teacher = nn.parallel.DistributedDataParallel(motion_teacher, device_ids=[args.gpu])
+            motion_teacher = nn.parallel.DistributedDataParallel(motion_teacher, device_ids=[args.gpu],
+                                                                 find_unused_parameters=False,
+                                                                 broadcast_buffers=False)
             motion_teacher_without_ddp = motion_teacher.module
         else:
             # teacher_without_ddp and teacher are the same thing
             motion_teacher_without_ddp = motion_teacher
 
-        motion_student = nn.parallel.DistributedDataParallel(motion_student, device_ids=[args.gpu])
+        motion_student = nn.parallel.DistributedDataParallel(motion_student, device_ids=[args.gpu],
+                                                             gradient_as_bucket_view=True, bucket_cap_mb=100)
+        motion_student._set_static_graph()
         motion_teacher_without_ddp.load_state_dict(motion_student.module.state_dict())
         for p in motion_teacher.parameters():
             p.requires_grad = False
@@ -322,7 +354,8 @@ def train_svt(args):
         args.warmup_teacher_temp_epochs,
         args.epochs,
         global_crops=2,
-        two_token=config.MODEL.TWO_TOKEN
+        two_token=config.MODEL.TWO_TOKEN,
+        compile_loss=args.compile_loss,
     ).cuda()
 
     if config.MODEL.TWO_STREAM:
@@ -347,9 +380,9 @@ def train_svt(args):
         optimizer = torch.optim.SGD(params_groups, lr=0, momentum=0.9)  # lr is set by scheduler
     elif args.optimizer == "lars":
         optimizer = utils.LARS(params_groups)  # to use with convnet and large batches
-    # for mixed precision training
+    # for mixed precision training, bf16 does not need loss scaling
     fp16_scaler = None
-    if args.use_fp16:
+    if args.use_fp16 and args.amp_dtype == "fp16":
         fp16_scaler = torch.cuda.amp.GradScaler()
 
     # ============ init schedulers ... ============
@@ -367,6 +400,9 @@ def train_svt(args):
     # momentum parameter is increased to 1. during training with a cosine schedule
     momentum_schedule = utils.cosine_scheduler(args.momentum_teacher, 1,
                                                args.epochs, len(data_loader))
+    # the foreach EMA and the param groups take python scalars, index plain floats instead of numpy scalars
+    lr_schedule, wd_schedule, momentum_schedule = \
+        lr_schedule.tolist(), wd_schedule.tolist(), momentum_schedule.tolist()
     print(f"Loss, optimizer and schedulers ready.")
 
     # ============ optionally resume training ... ============
@@ -382,6 +418,11 @@ def train_svt(args):
     )
     start_epoch = to_restore["epoch"]
 
+    # (student, teacher) parameter lists of the EMA update, the parameters never change identity
+    ema_params = [(list(student.module.parameters()), list(teacher_without_ddp.parameters()))]
+    if config.MODEL.TWO_STREAM:
+        ema_params.append((list(motion_student.module.parameters()), list(motion_teacher_without_ddp.parameters())))
+
     start_time = time.time()
     print("Starting DINO training !")
     train_loss = []
@@ -395,24 +436,26 @@ def train_svt(args):
                                       epoch, fp16_scaler, args, cfg=config,
                                       motion_loss=dino_flow_loss, cross_loss=dino_cross_loss,
                                       motion_student=motion_student, motion_teacher=motion_teacher,
-                                      motion_teacher_without_ddp=motion_teacher_without_ddp, rand_conv=rand_conv)
+                                      motion_teacher_without_ddp=motion_teacher_without_ddp, rand_conv=rand_conv,
+                                      ema_stream=ema_stream, ema_params=ema_params)
 
         # ============ writing logs ... ============
-        save_dict = {
-            'student': student.state_dict(),
-            'teacher': teacher.state_dict(),
-            'motion_student': motion_student.state_dict() if motion_student is not None else 0,
-            'motion_teacher': motion_teacher.state_dict() if motion_teacher is not None else 0,
-            'optimizer': optimizer.state_dict(),
-            'epoch': epoch + 1,
-            'args': args,
-            'dino_loss': dino_loss.state_dict(),
-        }
-        if fp16_scaler is not None:
-            save_dict['fp16_scaler'] = fp16_scaler.state_dict()
-        utils.save_on_master(save_dict, os.path.join(args.output_dir, 'checkpoint.pth'))
-        if args.saveckp_freq and epoch % args.saveckp_freq == 0:
-            utils.save_on_master(save_dict, os.path.join(args.output_dir, f'checkpoint{epoch:04}.pth'))
+        if utils.is_main_process():  # only the master writes, skip the state_dict walk elsewhere
+            save_dict = {
+                'student': student.state_dict(),
+                'teacher': teacher.state_dict(),
+                'motion_student': motion_student.state_dict() if motion_student is not None else 0,
+                'motion_teacher': motion_teacher.state_dict() if motion_teacher is not None else 0,
+                'optimizer': optimizer.state_dict(),
+                'epoch': epoch + 1,
+                'args': args,
+                'dino_loss': dino_loss.state_dict(),
+            }
+            if fp16_scaler is not None:
+                save_dict['fp16_scaler'] = fp16_scaler.state_dict()
+            utils.save_on_master(save_dict, os.path.join(args.output_dir, 'checkpoint.pth'))
+            if args.saveckp_freq and epoch % args.saveckp_freq == 0:
+                utils.save_on_master(save_dict, os.path.join(args.output_dir, f'checkpoint{epoch:04}.pth'))
         log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
                      'epoch': epoch}  # **{f'val_{k}': v for k, v in val_stats.items()},
 
@@ -422,7 +465,7 @@ def train_svt(args):
             with (Path(args.output_dir) / "log.txt").open("a") as f:
                 f.write(json.dumps(log_stats) + "\n")
 
-        if epoch % args.saveckp_freq == 0:
+        if utils.is_main_process() and epoch % args.saveckp_freq == 0:
             plt.clf()
             plt.plot(range(epoch + 1), train_loss, label='train_loss', marker='o')
             plt.title('train_loss_epoch')
@@ -431,60 +474,72 @@ def train_svt(args):
             plt.legend()
             plt.grid(True)
             plt.savefig(f'checkpoint/loss_plot_epoch_{epoch}.png')
-            plt.pause(0.1)
-            plt.ioff()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
 
 
-def GlobalAttGuidedMask(attention, masking_ratio, b, T, threshold):  # attention [B,T,196]
-    attention = attention.mean(1)
+def GlobalAttGuidedMask(attention, masking_ratio, b, T, threshold):  # attention [B,196]
     N_vis = math.ceil(attention.size(1) * (1 - masking_ratio))
 
     top_k = int(attention.shape[1] * threshold)
     top_indices = torch.topk(attention, k=top_k, dim=1)[1]
-    randomChoice_top_indices = torch.randperm(top_indices.size(1))[:N_vis]
-    result_random_top = top_indices[:, randomChoice_top_indices]
-
-    bottom_k = attention.shape[1] - top_k
-    bottom_indices = torch.topk(attention, k=bottom_k, largest=False, dim=1)[1]
-    randomChoice_bottom_indices = torch.randperm(bottom_indices.size(1))[:0]
-    result_random_bottom = bottom_indices[:, randomChoice_bottom_indices]
-    vis_idx_ = torch.cat([result_random_top, result_random_bottom], dim=1)
-
-    masks_attn = torch.ones((attention.shape[0], attention.shape[1])).to(attention.device, non_blocking=True)
-    masks_attn.scatter_(dim=-1, index=vis_idx_.long(), value=0.0)
-    masks_attn = masks_attn.unsqueeze(1).expand(-1, T, -1).reshape(b * T, -1)
-    mask = masks_attn.reshape(-1, 224 // args.patch_size, 224 // args.patch_size)  # [[BT,14,14],[BT,14,14]]
+    # sample N_vis of the high-attention tokens independently for every sample
+    noise = torch.rand(top_indices.shape, device=attention.device)
+    # with threshold < 1 - masking_ratio there are fewer candidates than N_vis, keep them all
+    vis_idx_ = torch.gather(top_indices, 1, noise.topk(min(N_vis, top_k), dim=1)[1])
+
+    masks_attn = torch.ones(attention.shape, device=attention.device, dtype=torch.bool)
+    masks_attn.scatter_(dim=-1, index=vis_idx_, value=False)
+    # expand + reshape instead of repeat_interleave, which reads the output size back to the host
+    h = int(attention.shape[1] ** 0.5)
+    mask = masks_attn.unsqueeze(1).expand(-1, T, -1).reshape(b * T, h, h)  # [[BT,14,14],[BT,14,14]]
     return vis_idx_, mask
 
 
 def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loader, masking_ratio, threshold,
                     global_crops_number, optimizer, lr_schedule, wd_schedule, momentum_schedule, epoch,
                     fp16_scaler, args, cfg=None, motion_teacher=None, motion_student=None,
-                    motion_loss=None, cross_loss=None, motion_teacher_without_ddp=None, rand_conv=None):
+                    motion_loss=None, cross_loss=None, motion_teacher_without_ddp=None, rand_conv=None,
+                    ema_stream=None, ema_params=None):
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = 'Epoch: [{}/{}]'.format(epoch, args.epochs)
-    for it, (images, masks_, _, _, meta) in enumerate(metric_logger.log_every(data_loader, 10, header)):
+    amp_dtype = torch.bfloat16 if args.amp_dtype == "bf16" else torch.float16
+    H = W = 96 // args.patch_size  # token grid of the local crops
+    # with DATA.UINT8_VIEWS the loader hands over uint8 views, normalize them on the gpu
+    mean = torch.tensor([0.485, 0.456, 0.406], device="cuda").view(1, 3, 1, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225], device="cuda").view(1, 3, 1, 1, 1)
+    # non-finite losses are flagged on the gpu and only checked every few iterations to avoid a sync per step
+    nan_flag = torch.zeros(1, device="cuda", dtype=torch.bool)
+    last_it = len(data_loader) * (epoch + 1) - 1
+    # the losses are kept on the gpu and only read back when the logger prints
+    print_freq = 10
+    loss_buffer = {'loss': [], 'loss_MIM_global': [], 'loss_MIM_local': []}
+    for k in loss_buffer:
+        # every update carries the mean of print_freq steps, keep the printed median at about 20 steps
+        metric_logger.add_meter(k, utils.SmoothedValue(window_size=2))
+    for data_iter_step, (images, masks_, _, _, meta) in enumerate(metric_logger.log_every(data_loader, print_freq,
+                                                                                          header)):
         # update weight decay and learning rate according to their schedule
-        it = len(data_loader) * epoch + it  # global training iteration
-        for i, param_group in enumerate(optimizer.param_groups):
-            param_group["lr"] = lr_schedule[it]
-            if i == 0:  # only the first group is regularized
-                param_group["weight_decay"] = wd_schedule[it]
+        it = len(data_loader) * epoch + data_iter_step  # global training iteration
+        lr_now = lr_schedule[it]
+        optimizer.param_groups[0]["lr"] = lr_now
+        optimizer.param_groups[0]["weight_decay"] = wd_schedule[it]  # only the first group is regularized
+        optimizer.param_groups[1]["lr"] = lr_now
 
         # move images to gpu
         images = [im.cuda(non_blocking=True) for im in images]  # list:10 [B,C,T,H,W]
-        masks = []
-        for i in range(len(masks_)):  # local mask
-            if i <= 1:
-                continue
-            mask = masks_[i]
-            mask = rearrange(mask, 'b t n -> (b t) n')
-            mask = mask.reshape(-1, 96 // args.patch_size, 96 // args.patch_size)
-            mask = mask.bool()
-            masks.append(mask)
+        if images[0].dtype == torch.uint8:
+            images = [im.float().mul_(1 / 255.) for im in images]
+            if cfg.DATA.GPU_COLOR_AUG:
+                images = [batch_color_jitter(im, img_brightness=0.4, img_contrast=0.4, img_saturation=0.2)
+                          for im in images]
+            images = [im.sub_(mean).div_(std) for im in images]
+        # the masks of all the views come packed in one tensor, move it at once and split it per view
+        masks_ = masks_.cuda(non_blocking=True).bool()
+        mask_sizes = [im.size(0) * im.size(2) * (im.size(3) // args.patch_size) * (im.size(4) // args.patch_size)
+                      for im in images]
+        masks = [mask.view(-1, H, W) for mask in masks_.split(mask_sizes)[2:]]  # local mask
 
         if cfg.MODEL.TWO_STREAM:
             if cfg.DATA.NO_FLOW_AUG:
@@ -495,7 +550,9 @@ def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loade
             pass
 
         # teacher and student forward passes + compute dino loss
-        with torch.cuda.amp.autocast(fp16_scaler is not None):
+        # the teachers must be done with the EMA update of the previous iteration
+        torch.cuda.current_stream().wait_stream(ema_stream)
+        with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=args.use_fp16):
 
             if cfg.MODEL.TWO_STREAM:
                 student_output_rgb, student_output_flow = student(images)
@@ -512,38 +569,42 @@ def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loade
                 loss = dino_loss(student_output, teacher_output, epoch)
             else:
                 if rand_conv is not None:
-                    teacher_output, teacher_attention = teacher([images[0], rand_conv(images[1])],
-                                                                return_attention=True)
+                    teacher_output, teacher_attentions = teacher([images[0], rand_conv(images[1])],
+                                                                 return_attention=True, cls_only=True)
                 else:
-                    teacher_output, teacher_attentions = teacher(images[:2],
-                                                                 return_attention=True)  # Only two global views pass the teacher, and get their distribution [6, 65536] and self-attention
-
-                masks_attn_list = []
-                for u in range(global_crops_number):
-                    batch_size_per_gpu = args.batch_size_per_gpu
-                    T_global = teacher_attentions[u].size(0) // batch_size_per_gpu
-                    teacher_attention = teacher_attentions[u]
-                    # Get mean [CLS] token attention
-                    cls_attention = teacher_attention[:, :, 0, 1:].mean(1).reshape(batch_size_per_gpu, T_global,
-                                                                                   196).detach().clone()  # [BT,196]
-                    # Get AttMask. cls_attention should be in shape (batch_size, number_of_tokens)
-                    vis_idx, masks_attn = GlobalAttGuidedMask(cls_attention, masking_ratio, batch_size_per_gpu,
-                                                              T_global, threshold)
-                    masks_attn_list.append(masks_attn.bool())
-
-                student_output_global_vis_loss = student(images[:2], masks_attn_list)
-                student_output_local_vis_loss = student(images[2:], masks)  # local views apply random tube mask
-                student_output = student(images, masks=None)  # [30,65536]
+                    teacher_output, teacher_attentions = teacher(images[:2], return_attention=True,
+                                                                 cls_only=True)  # Only two global views pass the teacher, and get their distribution [6, 65536] and self-attention
+
+                # building the masks is index work only, keep it out of autocast
+                with torch.autocast(device_type='cuda', enabled=False):
+                    masks_attn_list = []
+                    for u in range(global_crops_number):
+                        batch_size_per_gpu = args.batch_size_per_gpu
+                        T_global = teacher_attentions[u].size(0) // batch_size_per_gpu
+                        # Get mean [CLS] token attention over frames, the teacher already averaged it over heads
+                        cls_attention = teacher_attentions[u].view(batch_size_per_gpu, T_global,
+                                                                   -1).mean(dim=1)  # [B,196]
+                        # Get AttMask. cls_attention should be in shape (batch_size, number_of_tokens)
+                        vis_idx, masks_attn = GlobalAttGuidedMask(cls_attention, masking_ratio, batch_size_per_gpu,
+                                                                  T_global, threshold)
+                        masks_attn_list.append(masks_attn)
+
+                # a single student forward runs every view both masked (global views with the attention-guided
+                # mask, local views with the random tube mask) and unmasked
+                student_output, (student_output_global_vis_loss, student_output_local_vis_loss) = student(
+                    images, masks_attn_list + masks, with_unmasked=True)  # [30,65536]
 
                 loss = dino_loss(student_output, teacher_output, epoch)
                 loss_total = loss + student_output_global_vis_loss + student_output_local_vis_loss
 
-        if not math.isfinite(loss_total.item()):
-            print("Loss_total is {}, stopping training".format(loss_total.item()), force=True)
-            sys.exit(1)
+        nan_flag |= ~torch.isfinite(loss_total.detach())
+        if (it + 1) % 50 == 0 or it == last_it:
+            if nan_flag.item():
+                print("Loss_total is not finite, stopping training", force=True)
+                sys.exit(1)
 
         # student update
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         param_norms = None
         if fp16_scaler is None:
             loss_total.backward()
@@ -562,34 +623,68 @@ def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loade
             fp16_scaler.step(optimizer)
             fp16_scaler.update()
 
-        # EMA update for the teacher
-        with torch.no_grad():
+        # EMA update for the teacher, on a side stream so it overlaps with loading the next batch
+        ema_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(ema_stream), torch.no_grad():
             m = momentum_schedule[it]  # momentum parameter
-            for param_q, param_k in zip(student.module.parameters(), teacher_without_ddp.parameters()):
-                param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
-
-            if cfg.MODEL.TWO_STREAM:
-                for param_q, param_k in zip(motion_student.module.parameters(),
-                                            motion_teacher_without_ddp.parameters()):
-                    param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
+            for student_params, teacher_params in ema_params:
+                utils.ema_update(teacher_params, student_params, m)
 
         # logging
-        torch.cuda.synchronize()
-        metric_logger.update(loss=loss_total.item())
-        metric_logger.update(loss_MIM_global=student_output_global_vis_loss.item())
-        metric_logger.update(loss_MIM_local=student_output_local_vis_loss.item())
+        loss_buffer['loss'].append(loss_total.detach())
+        loss_buffer['loss_MIM_global'].append(student_output_global_vis_loss.detach())
+        loss_buffer['loss_MIM_local'].append(student_output_local_vis_loss.detach())
+        if data_iter_step % print_freq == 0 or data_iter_step == len(data_loader) - 1:
+            for k, v in loss_buffer.items():
+                metric_logger.meters[k].update(torch.stack(v).mean().item(), n=len(v))
+                v.clear()
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(wd=optimizer.param_groups[0]["weight_decay"])
+    torch.cuda.current_stream().wait_stream(ema_stream)
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
+def dino_cross_entropy(student_output, teacher_output, center, temp, student_temp, pair_mask):
+    """
+    Cross-entropy between the sharpened teacher and the student distributions,
+    averaged over the (teacher view, student view) pairs selected by the
+    [global_crops, n_crops] pair_mask. Free of side effects so that it can be
+    compiled.
+    """
+    global_crops, n_crops = pair_mask.shape
+    student_out = student_output / student_temp
+    student_out = F.log_softmax(student_out, dim=-1)
+    student_out = student_out.view(n_crops, -1, student_out.size(-1))  # [10,B,65536]
+
+    # teacher centering and sharpening
+    # the teacher only provides targets, detach it first so that the softmax is not tracked by autograd
+    # (x - c) / temp as x * (1 / temp) - c / temp, the center is scaled on its single row,
+    # in a fresh fp32 copy, the head emits the autocast dtype and the caller may reuse teacher_output
+    inv_temp = 1.0 / temp
+    teacher_out = teacher_output.detach().to(torch.float32, copy=True).mul_(inv_temp).sub_(center * inv_temp)
+    teacher_out = F.softmax(teacher_out, dim=-1)  # [6,65536]
+    teacher_out = teacher_out.view(global_crops, -1, teacher_out.size(-1))  # [2,B,65536]
+
+    # cross-entropy of every (teacher view, student view) pair at once, averaged over the batch.
+    # the einsum is a GEMM, keep TF32 off for it so that it stays as exact as the elementwise products
+    allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+    torch.backends.cuda.matmul.allow_tf32 = False
+    try:
+        with torch.autocast(device_type='cuda', enabled=False):
+            loss_mat = -torch.einsum('gbd,cbd->gc', teacher_out.float(), student_out.float())
+            loss_mat = loss_mat / student_out.size(1)
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+    return (loss_mat * pair_mask).sum() / pair_mask.sum()  # n_loss_terms=18
+
+
 class DINOLoss(nn.Module):
     def __init__(self, out_dim, ncrops, warmup_teacher_temp, teacher_temp,
                  warmup_teacher_temp_epochs, nepochs, student_temp=0.1,
-                 center_momentum=0.9, global_crops=2, two_token=False):
+                 center_momentum=0.9, global_crops=2, two_token=False, compile_loss=False):
         super().__init__()
         self.student_temp = student_temp
         self.center_momentum = center_momentum
@@ -600,15 +695,27 @@ class DINOLoss(nn.Module):
             self.n_crops = 4
             self.global_crops = 2
             self.register_buffer("center", torch.zeros(2, out_dim))
+            # (token, teacher view, student view) of the loss terms
+            self.pairs = [(0, 0, 0), (0, 0, 1), (1, 1, 2), (1, 1, 3)]
         else:
             self.register_buffer("center", torch.zeros(1, out_dim))
+            # we skip cases where student and teacher operate on the same view
+            pair_mask = torch.ones(self.global_crops, self.n_crops)
+            pair_mask.fill_diagonal_(0)
+            self.register_buffer("pair_mask", pair_mask, persistent=False)
         # we apply a warm up for the teacher temperature because
         # a too high temperature makes the training instable at the beginning
-        self.teacher_temp_schedule = np.concatenate((
-            np.linspace(warmup_teacher_temp,
-                        teacher_temp, warmup_teacher_temp_epochs),
-            np.ones(nepochs - warmup_teacher_temp_epochs) * teacher_temp
-        ))
+        self.warmup_teacher_temp = warmup_teacher_temp
+        self.teacher_temp = teacher_temp
+        self.warmup_teacher_temp_epochs = warmup_teacher_temp_epochs
+        # (work handle, batch sum, batch size) of the center all_reduce still in flight
+        self._pending_center = None
+        self.cross_entropy = dino_cross_entropy
+        self.compiled = compile_loss and hasattr(torch, "compile")
+        if self.compiled:
+            self.cross_entropy = torch.compile(dino_cross_entropy, mode="reduce-overhead", dynamic=False)
+        elif compile_loss:
+            print("torch.compile is not available, the DINO loss runs eagerly.")
 
     def forward(self, student_output, teacher_output, epoch):
         """
@@ -618,66 +725,67 @@ class DINOLoss(nn.Module):
         n_loss_terms = 0
         if self.two_token:
             student_out = [x / self.student_temp for x in student_output]
-            student_out = [x.chunk(self.n_crops) for x in student_out]
+            student_out = [x.view(self.n_crops, -1, x.size(-1)) for x in student_out]  # [4,B,65536]
+
+            # the teacher only provides targets, keep its path out of autograd
+            teacher_output = [x.detach() for x in teacher_output]
+            # batch sum for the center update, one row per token
+            batch_center = torch.cat([x.sum(dim=0, keepdim=True) for x in teacher_output])  # [2,65536]
+            batch_size = len(teacher_output[0])
 
             # teacher centering and sharpening
-            temp = self.teacher_temp_schedule[epoch]
-            teacher_out = [F.softmax((x - self.center[idx]) / temp, dim=-1) for idx, x in enumerate(teacher_output)]
-            teacher_out = [x.detach().chunk(self.global_crops) for x in teacher_out]
-
-            for iv in range(len(student_out[0])):
-                if iv < 2:
-                    q = teacher_out[0][0]
-                    v = student_out[0][iv]
-                    loss = torch.sum(-q * F.log_softmax(v, dim=-1), dim=-1)
-                else:
-                    q = teacher_out[1][1]
-                    v = student_out[1][iv]
-                    loss = torch.sum(-q * F.log_softmax(v, dim=-1), dim=-1)
-                total_loss += loss.mean()
+            inv_temp = 1.0 / self.teacher_temp_at(epoch)
+            scaled_center = self.center * inv_temp
+            teacher_out = [F.softmax(x.to(torch.float32, copy=True).mul_(inv_temp).sub_(scaled_center[idx]), dim=-1)
+                           for idx, x in enumerate(teacher_output)]
+            teacher_out = [x.view(self.global_crops, -1, x.size(-1)) for x in teacher_out]
+
+            for token, iq, iv in self.pairs:
+                # soft-target cross-entropy, without materializing -q * log_softmax(v)
+                total_loss += F.cross_entropy(student_out[token][iv], teacher_out[token][iq])
                 n_loss_terms += 1
+            total_loss /= n_loss_terms
         else:
-            student_out = student_output / self.student_temp
-            student_out = student_out.chunk(
-                self.n_crops)
-
-            # teacher centering and sharpening
-            temp = self.teacher_temp_schedule[epoch]
-            teacher_out = F.softmax((teacher_output - self.center) / temp, dim=-1)  # [6,65536]
-            teacher_out = teacher_out.detach().chunk(
-                self.global_crops)
-
-            for iq, q in enumerate(teacher_out):
-                for v in range(len(student_out)):
-                    if v == iq:
-                        # we skip cases where student and teacher operate on the same view
-                        continue
-                    loss = torch.sum(-q * F.log_softmax(student_out[v], dim=-1), dim=-1)  # tensor:3 [xx,xx,xx]
-                    total_loss += loss.mean()
-                    n_loss_terms += 1  # n_loss_terms=18
-        total_loss /= n_loss_terms
-        self.update_center(teacher_output)
+            # batch sum for the center update
+            teacher_output = teacher_output.detach()
+            batch_center = teacher_output.sum(dim=0, keepdim=True)  # [1,65536]
+            batch_size = len(teacher_output)
+
+            temp = self.teacher_temp_at(epoch)
+            if self.compiled:
+                # a tensor, so that the temperature warmup does not recompile the loss
+                temp = torch.full((), temp, device=teacher_output.device)
+            total_loss = self.cross_entropy(student_output, teacher_output, self.center, temp, self.student_temp,
+                                            self.pair_mask)
+        self.update_center(batch_center, batch_size)
         return total_loss
 
-    @torch.no_grad()
-    def update_center(self, teacher_output):
+    def teacher_temp_at(self, epoch):
         """
-        Update center used for teacher output.
+        Teacher temperature of an epoch: linear from warmup_teacher_temp to
+        teacher_temp over the warmup epochs (both ends included), then constant.
         """
-        if isinstance(teacher_output, (tuple, list)):
-            batch_center = [torch.sum(x, dim=0, keepdim=True) for x in teacher_output]
-            dist.all_reduce(batch_center[0])
-            dist.all_reduce(batch_center[1])
-            batch_center = [x / (len(teacher_output[0]) * dist.get_world_size()) for x in batch_center]
-            self.center[0, :] = self.center[0, :] * self.center_momentum + batch_center[0] * (1 - self.center_momentum)
-            self.center[1, :] = self.center[1, :] * self.center_momentum + batch_center[1] * (1 - self.center_momentum)
-        else:
-            batch_center = torch.sum(teacher_output, dim=0, keepdim=True)
-            dist.all_reduce(batch_center)
-            batch_center = batch_center / (len(teacher_output) * dist.get_world_size())
+        if epoch >= self.warmup_teacher_temp_epochs:
+            return self.teacher_temp
+        t = epoch / max(self.warmup_teacher_temp_epochs - 1, 1)
+        return self.warmup_teacher_temp + t * (self.teacher_temp - self.warmup_teacher_temp)
 
-            # ema update
-            self.center = self.center * self.center_momentum + batch_center * (1 - self.center_momentum)
+    @torch.no_grad()
+    def update_center(self, batch_center, batch_size):
+        """
+        Update center used for teacher output, from the sum of the teacher
+        outputs over the local batch (one row per center, a single all_reduce).
+        The all_reduce runs asynchronously and is only applied at the next call,
+        so the center lags one step behind.
+        """
+        if self._pending_center is not None:
+            handle, pending_center, pending_size = self._pending_center
+            handle.wait()
+            pending_center = pending_center / (pending_size * dist.get_world_size())
+
+            # ema update, in place to avoid allocating a new center every step
+            self.center.mul_(self.center_momentum).add_(pending_center, alpha=1 - self.center_momentum)
+        self._pending_center = (dist.all_reduce(batch_center, async_op=True), batch_center, batch_size)
 
 
 class DataAugmentationDINO(object):
@@ -349,6 +349,17 @@ _C.DATA.NO_RGB_AUG = False
 _C.DATA.RAND_CONV = False
 _C.DATA.NO_SPATIAL = False
 _C.DATA.RAND_FR = True
+# If True, the loader hands the pretraining views over as uint8 and the mean/std normalization runs
+# on the gpu, a 4x smaller worker-to-main-process payload. Off by default as it changes the inputs
+# of the reference recipe: the views are quantized to steps of 1/255 and clamped to [0, 1], which
+# cuts off the brightness jitter and bicubic overshoot above 1.0.
+_C.DATA.UINT8_VIEWS = False
+# If True, the color jitter and grayscale of the pretraining views run batched on the gpu
+# (datasets.transform.batch_color_jitter) instead of in the loader workers. Off by default as
+# it is not bit-compatible with the reference recipe: the jitter order is drawn per batch
+# instead of per clip, and the jitter runs after the views were quantized to uint8, so it implies
+# DATA.UINT8_VIEWS. Not supported with MODEL.TWO_TOKEN, DATA.NO_SPATIAL or DATA.NO_RGB_AUG.
+_C.DATA.GPU_COLOR_AUG = False
 
 ############
 _C.DATA.TEMPORAL_EXTENT = 8
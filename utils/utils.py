@@ -111,6 +111,19 @@ def clip_gradients(model, clip):
     return norms
 
 
+@torch.no_grad()
+def ema_update(teacher_params, student_params, m):
+    """
+    In-place EMA teacher <- m * teacher + (1 - m) * student over whole parameter
+    lists, with multi-tensor kernels instead of one launch per parameter.
+    """
+    if hasattr(torch, "_foreach_lerp_"):
+        torch._foreach_lerp_(teacher_params, student_params, 1 - m)
+    else:
+        torch._foreach_mul_(teacher_params, m)
+        torch._foreach_add_(teacher_params, student_params, alpha=1 - m)
+
+
 def cancel_gradients_last_layer(epoch, model, freeze_last_layer):
     if epoch >= freeze_last_layer:
         return
@@ -309,8 +322,19 @@ class MetricLogger(object):
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
-        for meter in self.meters.values():
-            meter.synchronize_between_processes()
+        """
+        Warning: does not synchronize the deques! The counts and totals of all
+        the meters go through a single all_reduce.
+        """
+        if not is_dist_avail_and_initialized() or not self.meters:
+            return
+        meters = list(self.meters.values())
+        t = torch.tensor([[meter.count, meter.total] for meter in meters], dtype=torch.float64, device='cuda')
+        dist.barrier()
+        dist.all_reduce(t)
+        for meter, (count, total) in zip(meters, t.tolist()):
+            meter.count = int(count)
+            meter.total = total
 
     def add_meter(self, name, meter):
         self.meters[name] = meter
@@ -455,6 +479,8 @@ def init_distributed_mode(args):
         print('Does not support training without GPU.')
         sys.exit(1)
 
+    # let NCCL surface errors and timeouts instead of hanging the job
+    os.environ.setdefault("NCCL_ASYNC_ERROR_HANDLING", "1")
     dist.init_process_group(
         backend="nccl",
         init_method=args.dist_url,
@@ -579,7 +605,7 @@ class MultiCropWrapper(nn.Module):
         self.head = head
         self.vary_fr = vary_fr
 
-    def forward(self, x, masks=None, return_attention=False, **kwargs):
+    def forward(self, x, masks=None, return_attention=False, with_unmasked=False, **kwargs):
         # convert to list
         if not isinstance(x, list):
             x = [x]
@@ -598,10 +624,27 @@ class MultiCropWrapper(nn.Module):
         if masks is not None:
             loss = 0
             start_1 = 0
-            if len(masks) == 8:
+            if len(masks) == 10:
+                idx_m = [1, 2, 4, 6, 8, 10]
+            elif len(masks) == 8:
                 idx_m = [2, 4, 6, 8]
             elif len(masks) == 2:
                 idx_m = [1, 2]
+            if with_unmasked:
+                # each masked group is stacked with its unmasked copy so that a single backbone forward gives
+                # both the reconstruction loss and the [CLS] features; the losses are summed into
+                # (global, local), the two global views always come first
+                output = []
+                loss = [0, 0]
+                for end_1 in idx_m:
+                    _x = torch.cat(x[start_1: end_1])
+                    _m = torch.cat(masks[start_1: end_1])
+                    _out_vis_loss, _out = self.backbone(torch.cat((_x, _x)), torch.cat((_m, torch.zeros_like(_m))),
+                                                        return_cls=True, **kwargs)
+                    output.append(_out[_x.size(0):])
+                    loss[0 if end_1 <= 2 else 1] += _out_vis_loss
+                    start_1 = end_1
+                return self.head(torch.cat(output)), loss
             for end_1 in idx_m:
                 _out_vis_loss, _ = self.backbone(torch.cat(x[start_1: end_1]), torch.cat(masks[start_1: end_1]), **kwargs)
                 loss += _out_vis_loss